@@ -8,36 +8,167 @@ import json
 import logging
 import asyncio
 import websockets
+from ws_transport import ws_messages
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import time
 from datetime import datetime
-from tabulate import tabulate
-from collections import deque
-import pandas as pd
-import os
+from itertools import islice
+from record_buffer import ColumnBuffer
+from sortedcontainers import SortedDict
+import numpy as np
+import aiohttp
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sys
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+try:
+    import msgspec
+    
+    class _DepthUpdate(msgspec.Struct):
+        """幣安depthUpdate消息的固定schema（僅聲明熱路徑用到的字段）"""
+        e: str
+        u: int
+        b: list
+        a: list
+    
+    # 按固定schema直接解碼成struct，免去通用dict的構建
+    _DEPTH_DECODER = msgspec.json.Decoder(_DepthUpdate)
+except ImportError:
+    msgspec = None
+    _DEPTH_DECODER = None
+
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    # SIMD加速的惰性解析：只取用到的字段，不物化整棵JSON樹
+    import simdjson
+except ImportError:
+    simdjson = None
+
+def _topk_aggregate(bid_sz, ask_sz):
+    """前N檔買/賣總量聚合（NaN為補位檔）"""
+    return np.nansum(bid_sz), np.nansum(ask_sz)
+
+def _scan_side(prices, qtys, bound, is_bid):
+    """掃描一側增量檔位：返回刪除掩碼與是否觸及前N檔邊界
+
+    numpy回退版做兩遍向量化掃描；numba版在下方覆蓋為單遍融合循環。
+    bound傳∓inf表示邊界未知，一律視為觸及。
+    """
+    removed = qtys == 0.0
+    if is_bid:
+        return removed, bool((prices >= bound).any())
+    return removed, bool((prices <= bound).any())
+
+if njit is not None:
+    # Numba可用時JIT編譯，並在啟動時預熱，首條消息不承擔編譯成本
+    _topk_aggregate = njit(cache=True, fastmath=True)(_topk_aggregate)
+    _topk_aggregate(np.zeros(1), np.zeros(1))
+
+    def _scan_side(prices, qtys, bound, is_bid):
+        removed = np.empty(prices.shape[0], dtype=np.bool_)
+        touched = False
+        for i in range(prices.shape[0]):
+            removed[i] = qtys[i] == 0.0
+            if is_bid:
+                if prices[i] >= bound:
+                    touched = True
+            elif prices[i] <= bound:
+                touched = True
+        return removed, touched
+
+    _scan_side = njit(cache=True)(_scan_side)
+    # 預熱要用跨步切片：運行時傳入的是arr[:, 0]/arr[:, 1]這類非連續視圖，
+    # 用連續數組預熱會讓首條真實消息再觸發一次特化編譯
+    _warmup = np.zeros((1, 2))
+    _scan_side(_warmup[:, 0], _warmup[:, 1], 0.0, True)
+    del _warmup
+
+
 class BinanceSpotOrderbook:
-    def __init__(self, symbol="BTCUSDT", depth_levels=10, enable_recording=False):
+    def __init__(self, symbol="BTCUSDT", depth_levels=10, enable_recording=False,
+                 enable_display=None, stream="diff", buffer_size=1000, flush_interval=5,
+                 record_mode="raw", snapshot_interval=0.01):
         self.symbol = symbol.upper()
         self.depth_levels = depth_levels
         self.enable_recording = enable_recording
+        # 錄製模式下默認關閉顯示，避免終端渲染佔用接收CPU
+        self.enable_display = (not enable_recording) if enable_display is None else enable_display
+        self.last_display_time = 0.0
+        self.display_interval = 0.1  # 顯示刷新限流（秒）
         
-        # WebSocket配置
-        self.ws_url = f"wss://stream.binance.com:9443/ws/{self.symbol.lower()}@depth"
+        # WebSocket配置：diff為增量深度流；depthN為交易所前N檔快照流(100ms)，
+        # 後者直接推送排序好的前N檔，完全繞過本地全簿維護
+        self.stream = stream
+        if stream == "diff":
+            self.ws_url = f"wss://stream.binance.com:9443/ws/{self.symbol.lower()}@depth"
+        else:
+            self.ws_url = f"wss://stream.binance.com:9443/ws/{self.symbol.lower()}@{stream}@100ms"
         
-        # 數據緩衝區
-        self.data_buffer = deque(maxlen=10000)
+        # 錄製列定義：行以tuple存入緩衝區，列名全體共享一份
+        # 相比每行一個16+4N鍵的dict可大幅降低緩衝區內存與GC壓力
+        self._record_fields = [
+            "timestamp_ns", "sequence_id", "exchange", "symbol", "event_type",
+            "best_bid", "best_ask", "best_bid_size", "best_ask_size",
+            "spread", "spread_percent", "mid_price",
+            "total_bid_volume", "total_ask_volume",
+        ]
+        for i in range(depth_levels):
+            self._record_fields += [f"bid_px_{i}", f"bid_sz_{i}", f"ask_px_{i}", f"ask_sz_{i}"]
+        
+        # 預分配的顯示/錄製行：常量字段只填一次，熱路徑就地覆寫
+        self._display_row = {key: None for key in self._record_fields}
+        self._display_row["exchange"] = "binance_spot"
+        self._display_row["symbol"] = self.symbol
+        self._display_row["event_type"] = "depthUpdate"
+        # 預生成各檔位鍵名，避免每條消息做f-string拼接
+        self._level_keys = [(f"bid_px_{i}", f"bid_sz_{i}", f"ask_px_{i}", f"ask_sz_{i}")
+                            for i in range(depth_levels)]
+        
+        # 刷盤串行化：ColumnBuffer雙緩衝要求同一時刻至多一次flush在途
+        self._flush_lock = asyncio.Lock()
+        # 數據緩衝區：SoA列式緩衝，追加標量而非整行tuple，滿載時丟新記錄
+        self.data_buffer = ColumnBuffer(
+            self._record_fields,
+            typecodes={"timestamp_ns": 'q', "sequence_id": 'q',
+                       "exchange": None, "symbol": None, "event_type": None},
+            capacity=buffer_size * 2)
+        # 刷盤執行器：由統一錄製器注入共享線程池，獨立運行時用默認池
+        self.write_executor = None
+        # 錄製模式：raw=逐條深度事件；coalesce=按固定間隔快照前N檔，
+        # 同檔位毫秒內的連續覆寫只留最終狀態，寫入量低一到兩個數量級
+        self.record_mode = record_mode
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_task = None
+        self._last_emit_count = 0
+        # 定點化比例：從exchangeInfo的tickSize/stepSize求得，獲取失敗時保持float存儲
+        self.price_scale = None
+        self.size_scale = None
+        self._record_scales = None
         self.last_flush_time = time.time()
-        self.flush_interval = 5  # 秒
-        self.buffer_size = 1000
+        self.flush_interval = flush_interval  # 秒
+        self.buffer_size = buffer_size
         
-        # 訂單簿數據
-        self.orderbook = {"bids": {}, "asks": {}}
+        # 訂單簿數據（SortedDict維持價格有序，買單按價格降序）
+        self.orderbook = {"bids": SortedDict(lambda p: -p), "asks": SortedDict()}
         self.sequence_id = 0
         
+        # 前N檔快照緩存：只有觸及前N檔範圍的更新才重建
+        self._topk_cache = None
+        self._bid_floor = None
+        self._ask_ceiling = None
+        
         # 統計信息
         self.msg_count = 0
         self.start_time = time.time()
@@ -47,107 +178,293 @@ class BinanceSpotOrderbook:
         if self.enable_recording:
             self.data_dir = Path("orderbook_data/binance_spot") / self.symbol
             self.data_dir.mkdir(parents=True, exist_ok=True)
+        
+        # 錄製管道：接收協程只入隊，獨立寫入任務負責緩衝與落盤
+        self._record_q = None
+        self._writer_task = None
+        self._dropped_records = 0
+        self.max_write_batch = 512  # 每次喚醒最多批量取走的記錄數
+        
+        # simdjson解析器按收集器復用，內部SIMD對齊緩衝不必每條消息重建
+        self._json_parser = simdjson.Parser() if simdjson is not None else None
+        
+        # 殭屍連接檢測：最後一條真實消息的單調時鐘，由統一錄製器的看門狗檢查
+        self._last_msg_mono = time.monotonic()
+        self.stale_threshold = 10.0  # 秒；100ms推送流下遠超正常間隔
+        
+        # Parquet追加寫入器（每小時一個文件，保持打開狀態追加row group）
+        self._pq_writer = None
+        self._pq_hour = None
+        self._pq_path = None
     
+    async def fetch_symbol_filters(self):
+        """從exchangeInfo獲取tickSize/stepSize並切換到定點int64錄製
+
+        價格按tick、數量按step量化成int64後存儲：parquet的整數
+        字典/RLE編碼遠優於float64，且不丟失交易所原生精度。
+        """
+        try:
+            url = "https://api.binance.com/api/v3/exchangeInfo?symbol=" + self.symbol
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url, timeout=5) as response:
+                    if response.status != 200:
+                        raise ValueError(f"HTTP {response.status}")
+                    data = await response.json()
+            filters = {flt['filterType']: flt for flt in data['symbols'][0]['filters']}
+            tick_size = float(filters['PRICE_FILTER']['tickSize'])
+            step_size = float(filters['LOT_SIZE']['stepSize'])
+            self.price_scale = round(1 / tick_size)
+            self.size_scale = round(1 / step_size)
+        except Exception as e:
+            logger.warning("獲取交易對精度失敗，改用float64存儲: %s", e)
+            return
+
+        # 價格類字段乘price_scale、數量類乘size_scale，其餘不量化
+        scales = {
+            "best_bid": self.price_scale, "best_ask": self.price_scale,
+            "spread": self.price_scale, "mid_price": self.price_scale,
+            "best_bid_size": self.size_scale, "best_ask_size": self.size_scale,
+            "total_bid_volume": self.size_scale, "total_ask_volume": self.size_scale,
+        }
+        typecodes = {"timestamp_ns": 'q', "sequence_id": 'q',
+                     "exchange": None, "symbol": None, "event_type": None}
+        for i in range(self.depth_levels):
+            scales[f"bid_px_{i}"] = scales[f"ask_px_{i}"] = self.price_scale
+            scales[f"bid_sz_{i}"] = scales[f"ask_sz_{i}"] = self.size_scale
+        self._record_scales = [scales.get(name) for name in self._record_fields]
+        for name in scales:
+            typecodes[name] = 'q'
+        typecodes["spread_percent"] = 'd'
+        self.data_buffer = ColumnBuffer(self._record_fields, typecodes=typecodes,
+                                        capacity=self.buffer_size * 2)
+        logger.info("啟用定點存儲: price_scale=%d size_scale=%d",
+                    self.price_scale, self.size_scale)
+
+    def _build_record(self, processed_data):
+        """按字段比例表量化生成一行記錄（None/NaN補位值記為0）"""
+        return tuple(
+            v if s is None else (int(round(v * s)) if v is not None and v == v else 0)
+            for v, s in zip((processed_data[k] for k in self._record_fields),
+                            self._record_scales)
+        )
+
     async def connect(self):
         """連接到WebSocket並開始接收數據"""
         reconnect_delay = 1
         max_reconnect_delay = 60
         
+        # 啟動獨立寫入任務，磁盤刷新不再阻塞接收循環
+        if self.enable_recording and self._writer_task is None:
+            await self.fetch_symbol_filters()
+            self._record_q = asyncio.Queue(maxsize=2000)
+            self._writer_task = asyncio.create_task(self._writer_loop())
+            if self.record_mode == "coalesce":
+                self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+        
         while True:
             try:
-                print(f"\033[1;32m[幣安現貨] 連接到: {self.ws_url}\033[0m")
-                logger.info(f"Connecting to Binance Spot WebSocket: {self.ws_url}")
+                logger.info("Connecting to Binance Spot WebSocket: %s", self.ws_url)
+                # 連接嘗試本身算作活動，避免看門狗在重連退避期間誤觸發
+                self._last_msg_mono = time.monotonic()
                 
-                async with websockets.connect(self.ws_url) as websocket:
-                    print(f"\033[1;32m[幣安現貨] WebSocket連接成功! 訂閱 {self.symbol} 深度數據\033[0m")
-                    reconnect_delay = 1  # 重置重連延遲
-                    
-                    async for message in websocket:
-                        try:
-                            await self.process_message(message)
-                        except Exception as e:
-                            logger.error(f"處理消息時出錯: {e}", exc_info=True)
+                # 傳輸層適配：picows可用時直接回調入隊，否則回退websockets
+                # （關閉permessage-deflate：深度幀較小，帶寬節省抵不上每幀zlib解壓CPU）
+                connected = False
+                async for message in ws_messages(self.ws_url,
+                                                 compression=None,
+                                                 max_size=2**20,
+                                                 ping_interval=20,
+                                                 ping_timeout=20):
+                    if not connected:
+                        logger.info("WebSocket connected, subscribed %s depth", self.symbol)
+                        reconnect_delay = 1  # 重置重連延遲
+                        connected = True
+                    try:
+                        await self.process_message(message)
+                    except Exception as e:
+                        logger.error("處理消息時出錯: %s", e, exc_info=True)
                             
             except (websockets.exceptions.ConnectionClosed, ConnectionRefusedError) as e:
-                print(f"\033[1;33m[幣安現貨] 連接斷開: {e}, {reconnect_delay}秒後重連...\033[0m")
-                logger.warning(f"WebSocket connection lost: {e}")
+                logger.warning("WebSocket connection lost: %s, reconnecting in %ss", e, reconnect_delay)
                 await asyncio.sleep(reconnect_delay)
                 reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)
                 
             except Exception as e:
-                print(f"\033[1;31m[幣安現貨] 連接錯誤: {e}, {reconnect_delay}秒後重連...\033[0m")
-                logger.error(f"WebSocket error: {e}", exc_info=True)
+                logger.error("WebSocket error: %s, reconnecting in %ss", e, reconnect_delay, exc_info=True)
                 await asyncio.sleep(reconnect_delay)
                 reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)
     
     async def process_message(self, message):
         """處理接收到的WebSocket消息"""
+        self._last_msg_mono = time.monotonic()
         try:
-            data = json.loads(message)
+            # 部分深度快照流：payload本身就是前N檔，整簿替換即可
+            if self.stream != "diff":
+                if orjson is not None:
+                    data = orjson.loads(message)
+                else:
+                    data = json.loads(message)
+                bids = data.get('bids') or data.get('b')
+                asks = data.get('asks') or data.get('a')
+                if bids is None and asks is None:
+                    return
+                await self.handle_depth_snapshot(bids, asks, data.get('lastUpdateId', data.get('u')))
+                return
             
+            # 最優先走simdjson：E/e/s/U等未用字段完全不落地成Python對象
+            if self._json_parser is not None:
+                doc = self._json_parser.parse(message)
+                try:
+                    if doc['e'] != 'depthUpdate':
+                        return
+                    bids = doc['b'].as_list()
+                    asks = doc['a'].as_list()
+                    seq_id = doc['u']
+                except KeyError:
+                    return  # 非深度更新消息
+                await self.handle_depth_update(bids, asks, seq_id)
+                return
+            
+            # 次選msgspec的類型化解碼路徑
+            if _DEPTH_DECODER is not None:
+                try:
+                    upd = _DEPTH_DECODER.decode(message)
+                except msgspec.ValidationError:
+                    return  # 非深度更新消息
+                if upd.e == 'depthUpdate':
+                    await self.handle_depth_update(upd.b, upd.a, upd.u)
+                return
+            
+            # orjson直接接受bytes，比標準庫json快數倍
+            if orjson is not None:
+                data = orjson.loads(message)
+            else:
+                data = json.loads(message)
+
             # 檢查是否為深度更新事件
             if 'e' in data and data['e'] == 'depthUpdate':
-                await self.handle_depth_update(data)
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON解析錯誤: {e}")
+                await self.handle_depth_update(data.get('b'), data.get('a'), data.get('u'))
+
+        except ValueError as e:
+            logger.error("JSON解析錯誤: %s", e)
         except Exception as e:
-            logger.error(f"處理消息時出錯: {e}", exc_info=True)
+            logger.error("處理消息時出錯: %s", e, exc_info=True)
+    
+    async def handle_depth_snapshot(self, bids, asks, seq_id):
+        """處理部分深度快照：整簿替換，無需增量維護"""
+        self.orderbook['bids'].clear()
+        self.orderbook['asks'].clear()
+        self._topk_cache = None
+        await self.handle_depth_update(bids, asks, seq_id)
     
-    async def handle_depth_update(self, data):
+    async def handle_depth_update(self, bids, asks, seq_id):
         """處理深度更新數據"""
         try:
             # 更新本地訂單簿
-            self.update_local_orderbook(data)
+            self.update_local_orderbook(bids, asks)
             
             # 統計信息
             self.msg_count += 1
-            self.last_update_time = datetime.now()
-            self.sequence_id = data.get('u', self.sequence_id)
+            self.last_update_time = time.time()
+            if seq_id is not None:
+                self.sequence_id = seq_id
             
             # 處理數據（顯示和錄製）
-            processed_data = self.process_orderbook_data(data)
+            processed_data = self.process_orderbook_data()
             
-            # 顯示訂單簿
-            self.display_orderbook(processed_data)
+            # 顯示訂單簿（限流刷新，熱路徑上跳過渲染）
+            if self.enable_display:
+                now = time.time()
+                if now - self.last_display_time >= self.display_interval:
+                    self.display_orderbook(processed_data)
+                    self.last_display_time = now
             
-            # 錄製數據
-            if self.enable_recording:
-                self.data_buffer.append(processed_data)
-                await self.check_flush_buffer()
+            # 錄製數據：只入隊，寫入任務負責緩衝與刷盤（coalesce模式由快照任務入隊）
+            if self.enable_recording and self.record_mode == "raw":
+                try:
+                    if self._record_scales is not None:
+                        record = self._build_record(processed_data)
+                    else:
+                        record = tuple(processed_data[k] for k in self._record_fields)
+                    self._record_q.put_nowait(record)
+                except asyncio.QueueFull:
+                    # 寫入積壓時寧可丟棄也不反壓接收循環
+                    self._dropped_records += 1
             
             # 定期顯示統計信息
-            if self.msg_count % 100 == 0:
+            if self.enable_display and self.msg_count % 100 == 0:
                 self.display_stats()
                 
         except Exception as e:
-            logger.error(f"處理深度更新時出錯: {e}", exc_info=True)
+            logger.error("處理深度更新時出錯: %s", e, exc_info=True)
     
-    def update_local_orderbook(self, data):
+    def update_local_orderbook(self, bids, asks):
         """更新本地訂單簿"""
-        # 更新買單
-        for bid in data.get('b', []):
-            price, quantity = float(bid[0]), float(bid[1])
-            if quantity == 0:
-                self.orderbook['bids'].pop(price, None)
-            else:
-                self.orderbook['bids'][price] = quantity
+        bids_book = self.orderbook['bids']
+        asks_book = self.orderbook['asks']
+        dirty = self._topk_cache is None
+        
+        # 更新買單：一次C層面的批量字符串轉換，替代逐檔float()
+        if bids:
+            arr = np.asarray(bids, dtype=np.float64)
+            prices, qtys = arr[:, 0], arr[:, 1]
+            bound = -np.inf if self._bid_floor is None else self._bid_floor
+            removed, touched = _scan_side(prices, qtys, bound, True)
+            for price in prices[removed]:
+                bids_book.pop(price, None)
+            if not removed.all():
+                bids_book.update(zip(prices[~removed], qtys[~removed]))
+            # 低於第N檔買價的變動不影響前N檔快照
+            if touched:
+                dirty = True
         
         # 更新賣單
-        for ask in data.get('a', []):
-            price, quantity = float(ask[0]), float(ask[1])
-            if quantity == 0:
-                self.orderbook['asks'].pop(price, None)
-            else:
-                self.orderbook['asks'][price] = quantity
+        if asks:
+            arr = np.asarray(asks, dtype=np.float64)
+            prices, qtys = arr[:, 0], arr[:, 1]
+            bound = np.inf if self._ask_ceiling is None else self._ask_ceiling
+            removed, touched = _scan_side(prices, qtys, bound, False)
+            for price in prices[removed]:
+                asks_book.pop(price, None)
+            if not removed.all():
+                asks_book.update(zip(prices[~removed], qtys[~removed]))
+            # 高於第N檔賣價的變動不影響前N檔快照
+            if touched:
+                dirty = True
+        
+        if dirty:
+            self._topk_cache = None
     
-    def process_orderbook_data(self, raw_data):
+    def process_orderbook_data(self):
         """處理訂單簿數據並計算衍生指標"""
-        timestamp = datetime.now()
         
-        # 獲取排序後的買賣單
-        sorted_bids = sorted(self.orderbook['bids'].items(), reverse=True)[:self.depth_levels]
-        sorted_asks = sorted(self.orderbook['asks'].items())[:self.depth_levels]
+        # 前N檔快照：更新未觸及前N檔時直接復用緩存的聚合結果
+        if self._topk_cache is None:
+            sorted_bids = list(islice(self.orderbook['bids'].items(), self.depth_levels))
+            sorted_asks = list(islice(self.orderbook['asks'].items(), self.depth_levels))
+            
+            # SoA佈局：前N檔展平成固定的float64數組，空檔補NaN
+            k = self.depth_levels
+            bid_px = np.full(k, np.nan)
+            bid_sz = np.full(k, np.nan)
+            ask_px = np.full(k, np.nan)
+            ask_sz = np.full(k, np.nan)
+            for i, (price, qty) in enumerate(sorted_bids):
+                bid_px[i] = price
+                bid_sz[i] = qty
+            for i, (price, qty) in enumerate(sorted_asks):
+                ask_px[i] = price
+                ask_sz[i] = qty
+            
+            total_bid_volume, total_ask_volume = _topk_aggregate(bid_sz, ask_sz)
+            self._topk_cache = (sorted_bids, sorted_asks, bid_px, bid_sz, ask_px, ask_sz,
+                                total_bid_volume, total_ask_volume)
+            # 記錄前N檔邊界，供update_local_orderbook判斷是否需要重建
+            self._bid_floor = sorted_bids[-1][0] if len(sorted_bids) == self.depth_levels else None
+            self._ask_ceiling = sorted_asks[-1][0] if len(sorted_asks) == self.depth_levels else None
+        else:
+            (sorted_bids, sorted_asks, bid_px, bid_sz, ask_px, ask_sz,
+             total_bid_volume, total_ask_volume) = self._topk_cache
         
         # 計算最佳買賣價
         best_bid = sorted_bids[0][0] if sorted_bids else None
@@ -160,79 +477,88 @@ class BinanceSpotOrderbook:
         spread_percent = (spread / best_ask * 100) if spread else None
         mid_price = ((best_bid + best_ask) / 2) if (best_bid and best_ask) else None
         
-        # 計算總量
-        total_bid_volume = sum([qty for _, qty in sorted_bids])
-        total_ask_volume = sum([qty for _, qty in sorted_asks])
-        
-        return {
-            "timestamp": timestamp.isoformat(),
-            "sequence_id": self.sequence_id,
-            "exchange": "binance_spot",
-            "symbol": self.symbol,
-            "event_type": "depthUpdate",
-            "bids": [[price, qty] for price, qty in sorted_bids],
-            "asks": [[price, qty] for price, qty in sorted_asks],
-            "best_bid": best_bid,
-            "best_ask": best_ask,
-            "best_bid_size": best_bid_size,
-            "best_ask_size": best_ask_size,
-            "spread": spread,
-            "spread_percent": spread_percent,
-            "mid_price": mid_price,
-            "total_bid_volume": total_bid_volume,
-            "total_ask_volume": total_ask_volume
-        }
+        # 就地覆寫預分配的行，不再每條消息新建dict
+        row = self._display_row
+        row["timestamp_ns"] = time.time_ns()
+        row["sequence_id"] = self.sequence_id
+        row["best_bid"] = best_bid
+        row["best_ask"] = best_ask
+        row["best_bid_size"] = best_bid_size
+        row["best_ask_size"] = best_ask_size
+        row["spread"] = spread
+        row["spread_percent"] = spread_percent
+        row["mid_price"] = mid_price
+        row["total_bid_volume"] = total_bid_volume
+        row["total_ask_volume"] = total_ask_volume
+        for i, (kbp, kbs, kap, kas) in enumerate(self._level_keys):
+            row[kbp] = bid_px[i]
+            row[kbs] = bid_sz[i]
+            row[kap] = ask_px[i]
+            row[kas] = ask_sz[i]
+        return row
+    
+    @staticmethod
+    def _format_rows(rows):
+        """固定寬度f-string渲染，省去tabulate的動態寬度計算開銷"""
+        lines = [f"{'價格':>12} {'數量':>12} {'總值':>14}"]
+        lines.extend(f"{p:>12.2f} {q:>12.4f} {v:>14.2f}" for p, q, v in rows)
+        return '\n'.join(lines)
     
     def display_orderbook(self, data):
         """顯示訂單簿數據"""
-        # 清屏（可選）
-        os.system('clear' if os.name == 'posix' else 'cls')
-        
-        print(f"\n{'='*60}")
-        print(f"🚀 幣安現貨實時訂單簿 - {data['symbol']}")
-        print(f"📅 時間: {data['timestamp'][:19]}")
-        print(f"🔢 序號: {data['sequence_id']}")
-        print(f"{'='*60}")
+        # ANSI清屏序列與整屏內容合併後一次性寫出，避免每次刷新約20次print的stdout鎖開銷
+        lines = ['\x1b[H\x1b[2J']
+        lines.append(f"\n{'='*60}")
+        lines.append(f"🚀 幣安現貨實時訂單簿 - {data['symbol']}")
+        lines.append(f"📅 時間: {datetime.fromtimestamp(data['timestamp_ns'] / 1e9).strftime('%Y-%m-%d %H:%M:%S')}")
+        lines.append(f"🔢 序號: {data['sequence_id']}")
+        lines.append(f"{'='*60}")
         
         # 顯示最佳價格信息
         if data['best_bid'] and data['best_ask']:
-            print(f"🟢 最佳買價: {data['best_bid']:.2f} (數量: {data['best_bid_size']:.4f})")
-            print(f"🔴 最佳賣價: {data['best_ask']:.2f} (數量: {data['best_ask_size']:.4f})")
-            print(f"📊 中間價: {data['mid_price']:.2f}")
-            print(f"📈 價差: {data['spread']:.2f} ({data['spread_percent']:.3f}%)")
+            lines.append(f"🟢 最佳買價: {data['best_bid']:.2f} (數量: {data['best_bid_size']:.4f})")
+            lines.append(f"🔴 最佳賣價: {data['best_ask']:.2f} (數量: {data['best_ask_size']:.4f})")
+            lines.append(f"📊 中間價: {data['mid_price']:.2f}")
+            lines.append(f"📈 價差: {data['spread']:.2f} ({data['spread_percent']:.3f}%)")
         
-        print(f"💰 總買量: {data['total_bid_volume']:.4f} | 總賣量: {data['total_ask_volume']:.4f}")
-        print()
+        lines.append(f"💰 總買量: {data['total_bid_volume']:.4f} | 總賣量: {data['total_ask_volume']:.4f}")
+        lines.append("")
         
         # 格式化賣單數據（從高到低）
         asks_display = []
-        for price, qty in reversed(data['asks']):
+        for i in reversed(range(self.depth_levels)):
+            price = data[f"ask_px_{i}"]
+            qty = data[f"ask_sz_{i}"]
+            if np.isnan(price):
+                continue
             total_value = price * qty
-            asks_display.append([f"{price:.2f}", f"{qty:.4f}", f"{total_value:.2f}"])
+            asks_display.append((price, qty, total_value))
         
         # 顯示賣單
         if asks_display:
-            print("📈 賣單 (Asks)")
-            print(tabulate(asks_display, 
-                          headers=["價格", "數量", "總值"],
-                          tablefmt="pretty",
-                          stralign="right"))
+            lines.append("📈 賣單 (Asks)")
+            lines.append(self._format_rows(asks_display))
         
-        print(f"\n{' '*20}--- 價差: {data['spread']:.2f} ---\n")
+        lines.append(f"\n{' '*20}--- 價差: {data['spread']:.2f} ---\n")
         
         # 格式化買單數據（從高到低）
         bids_display = []
-        for price, qty in data['bids']:
+        for i in range(self.depth_levels):
+            price = data[f"bid_px_{i}"]
+            qty = data[f"bid_sz_{i}"]
+            if np.isnan(price):
+                continue
             total_value = price * qty
-            bids_display.append([f"{price:.2f}", f"{qty:.4f}", f"{total_value:.2f}"])
+            bids_display.append((price, qty, total_value))
         
         # 顯示買單
         if bids_display:
-            print("📉 買單 (Bids)")
-            print(tabulate(bids_display,
-                          headers=["價格", "數量", "總值"],
-                          tablefmt="pretty",
-                          stralign="right"))
+            lines.append("📉 買單 (Bids)")
+            lines.append(self._format_rows(bids_display))
+        
+        # 整屏單次write+flush
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
     
     def display_stats(self):
         """顯示統計信息"""
@@ -240,11 +566,12 @@ class BinanceSpotOrderbook:
         elapsed = current_time - self.start_time
         rate = self.msg_count / elapsed if elapsed > 0 else 0
         
-        print(f"\n📊 統計信息:")
-        print(f"   消息總數: {self.msg_count}")
-        print(f"   接收頻率: {rate:.2f} msg/sec")
-        print(f"   緩衝區大小: {len(self.data_buffer)}")
-        print(f"   運行時間: {elapsed:.0f}秒")
+        sys.stdout.write(f"\n📊 統計信息:\n"
+                         f"   消息總數: {self.msg_count}\n"
+                         f"   接收頻率: {rate:.2f} msg/sec\n"
+                         f"   緩衝區大小: {len(self.data_buffer)}\n"
+                         f"   運行時間: {elapsed:.0f}秒\n")
+        sys.stdout.flush()
     
     async def check_flush_buffer(self):
         """檢查是否需要刷新緩衝區"""
@@ -258,37 +585,151 @@ class BinanceSpotOrderbook:
         if not self.data_buffer:
             return
         
+        async with self._flush_lock:
+            if not self.data_buffer:
+                return
+            # 原子換出：整組列的零拷貝視圖交給刷盤線程，備用列立即接收
+            snapshot = self.data_buffer.take()
+            self.last_flush_time = time.time()
+            
+            # Arrow表構建和磁盤寫入全部移出事件循環；
+            # 鎖保證下一次take()前本次寫盤已結束，視圖不會被覆寫
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.write_executor, self._do_flush, snapshot)
+    
+    def _do_flush(self, snapshot):
+        """同步刷盤助手：在線程池中構建Arrow表並追加寫入"""
         try:
-            # 獲取當前小時的文件名
+            # 按小時輪轉：跨小時時關閉舊writer並開新文件
             now = datetime.now()
-            # 使用統一的文件名格式：binance_spot_orderbook_BTCUSDT_YYYY_MM_DD_HH.parquet
-            filename = f"binance_spot_orderbook_{self.symbol}_{now.strftime('%Y_%m_%d_%H')}.parquet"
-            filepath = self.data_dir / filename
+            hour = now.strftime('%Y_%m_%d_%H')
             
-            # 轉換為DataFrame
-            df = pd.DataFrame(list(self.data_buffer))
+            # snapshot已是列式數組：數值列零拷貝進Arrow，無需轉置
+            table = pa.Table.from_arrays([pa.array(col) for col in snapshot],
+                                         names=self._record_fields)
             
-            # 保存到parquet文件（追加模式）
-            if filepath.exists():
-                existing_df = pd.read_parquet(filepath)
-                df = pd.concat([existing_df, df], ignore_index=True)
+            if self._pq_writer is None or hour != self._pq_hour:
+                self.close_writer()
+                schema = table.schema
+                if self.price_scale is not None:
+                    # 比例寫進文件元數據，讀取方據此還原真實價格/數量
+                    schema = schema.with_metadata({
+                        b"price_scale": str(self.price_scale).encode(),
+                        b"size_scale": str(self.size_scale).encode(),
+                    })
+                filename = f"binance_spot_orderbook_{self.symbol}_{hour}.parquet"
+                self._pq_path = self.data_dir / filename
+                # 同小時文件已存在（進程重啟、關停後的遲到刷盤）時換新
+                # 文件名：重開ParquetWriter會截斷已寫好的文件
+                seq = 1
+                while self._pq_path.exists():
+                    self._pq_path = self.data_dir / f"binance_spot_orderbook_{self.symbol}_{hour}_{seq}.parquet"
+                    seq += 1
+                self._pq_writer = pq.ParquetWriter(
+                    self._pq_path, schema, compression='snappy',
+                    use_dictionary=True, data_page_size=1 << 20)
+                self._pq_hour = hour
             
-            df.to_parquet(filepath, engine='pyarrow', compression='snappy')
+            # 只追加新的row group，避免讀回整個小時文件再整體重寫
+            if table.schema != self._pq_writer.schema:
+                table = table.cast(self._pq_writer.schema)
+            self._pq_writer.write_table(table)
             
-            print(f"\n💾 已保存 {len(self.data_buffer)} 條記錄到 {filepath}")
-            logger.info(f"Flushed {len(self.data_buffer)} records to {filepath}")
-            
-            # 清空緩衝區
-            self.data_buffer.clear()
-            self.last_flush_time = time.time()
+            logger.info("Flushed %d records to %s", table.num_rows, self._pq_path)
             
         except Exception as e:
-            logger.error(f"刷新緩衝區時出錯: {e}", exc_info=True)
+            logger.error("刷新緩衝區時出錯: %s", e, exc_info=True)
+    
+    async def _snapshot_loop(self):
+        """coalesce模式的快照任務：定期錄一行前N檔狀態而非逐條事件"""
+        while True:
+            try:
+                await asyncio.sleep(self.snapshot_interval)
+            except asyncio.CancelledError:
+                break
+            # 無新消息或訂單簿尚未建立時不產生重複快照
+            if self.msg_count == self._last_emit_count or not self.orderbook['bids']:
+                continue
+            self._last_emit_count = self.msg_count
+            processed_data = self.process_orderbook_data()
+            try:
+                if self._record_scales is not None:
+                    record = self._build_record(processed_data)
+                else:
+                    record = tuple(processed_data[k] for k in self._record_fields)
+                self._record_q.put_nowait(record)
+            except asyncio.QueueFull:
+                self._dropped_records += 1
+
+    async def _writer_loop(self):
+        """獨立寫入任務：批量抽乾錄製隊列，分攤每次刷盤的固定開銷
+
+        收到None哨兵時在完成當前刷盤後正常退出；停止流程不用cancel()，
+        取消會在run_in_executor等待點打斷協程並釋放_flush_lock，
+        而_do_flush仍在池線程裡寫文件，與最終刷盤並發寫壞同一小時文件。
+        """
+        stopping = False
+        while not stopping:
+            try:
+                record = await self._record_q.get()
+                if record is None:
+                    break
+                batch = [record]
+                # 一次喚醒盡量多取（上限max_write_batch），減少刷盤次數
+                while len(batch) < self.max_write_batch:
+                    try:
+                        item = self._record_q.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self.data_buffer.extend(batch)
+                await self.check_flush_buffer()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error("寫入任務出錯: %s", e, exc_info=True)
     
+    def close_writer(self):
+        """關閉當前的parquet writer（寫入文件尾部元數據）"""
+        if self._pq_writer is not None:
+            try:
+                self._pq_writer.close()
+            except Exception as e:
+                logger.error("關閉parquet writer時出錯: %s", e, exc_info=True)
+            self._pq_writer = None
+
     async def stop(self):
         """停止程序並保存剩餘數據"""
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            try:
+                await self._snapshot_task
+            except asyncio.CancelledError:
+                pass
+            self._snapshot_task = None
+        if self._writer_task is not None:
+            # 協作式關停：入隊哨兵並等待寫入任務自行退出，確保在途刷盤完成
+            await self._record_q.put(None)
+            await self._writer_task
+            self._writer_task = None
+        # 哨兵之後可能又有少量記錄入隊，排空進緩衝再做最終刷盤
+        if self._record_q is not None:
+            while True:
+                try:
+                    record = self._record_q.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if record is not None:
+                    self.data_buffer.append(record)
+        dropped = self._dropped_records + self.data_buffer.dropped
+        if dropped:
+            logger.warning("寫入積壓共丟棄 %d 條記錄", dropped)
         if self.enable_recording and self.data_buffer:
             await self.flush_buffer()
+        self.close_writer()
         print(f"\n🛑 程序已停止")
 
 async def main():
@@ -299,6 +740,9 @@ async def main():
     parser.add_argument('--symbol', default='BTCUSDT', help='交易對符號')
     parser.add_argument('--depth', type=int, default=10, help='顯示深度級數')
     parser.add_argument('--record', action='store_true', help='啟用數據錄製')
+    parser.add_argument('--display', action='store_true', help='強制啟用訂單簿顯示（錄製模式下默認關閉）')
+    parser.add_argument('--stream', choices=['diff', 'depth5', 'depth10', 'depth20'], default='diff',
+                        help='數據流類型：diff為增量深度流，depthN為交易所前N檔快照流(100ms)')
     
     args = parser.parse_args()
     
@@ -306,7 +750,9 @@ async def main():
     collector = BinanceSpotOrderbook(
         symbol=args.symbol,
         depth_levels=args.depth,
-        enable_recording=args.record
+        enable_recording=args.record,
+        enable_display=True if args.display else None,
+        stream=args.stream
     )
     
     try:
@@ -322,8 +768,14 @@ async def main():
         print(f"\n\033[1;33m收到停止信號...\033[0m")
         await collector.stop()
     except Exception as e:
-        logger.error(f"程序運行時出錯: {e}", exc_info=True)
+        logger.error("程序運行時出錯: %s", e, exc_info=True)
         await collector.stop()
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    try:
+        # uvloop可大幅降低事件循環開銷（Windows不支持）
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    asyncio.run(main())
\ No newline at end of file
@@ -4,32 +4,72 @@ Lighter合約實時Orderbook收集程序（升級版）
 實時接收每一筆orderbook變化並顯示/錄製
 """
 
-import json
 import logging
 import asyncio
 import lighter
 import time
-from tabulate import tabulate
 from datetime import datetime
 from collections import deque
-import pandas as pd
-import os
+from record_buffer import ColumnBuffer
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sys
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class LighterOrderbookRecorder:
-    def __init__(self, market_ids=[1], enable_recording=False):
+    def __init__(self, market_ids=[1], enable_recording=False, enable_display=None,
+                 buffer_size=500, flush_interval=3):
         self.market_ids = market_ids
+        self.depth_levels = 10
         self.enable_recording = enable_recording
+        # 錄製模式下默認關閉顯示，避免終端渲染佔用接收CPU
+        self.enable_display = (not enable_recording) if enable_display is None else enable_display
+        self.last_display_time = 0.0
+        self.display_interval = 0.1  # 顯示刷新限流（秒）
         self.loop = asyncio.get_event_loop()
         
-        # 數據緩衝區
-        self.data_buffer = deque(maxlen=10000)
+        # 回調收件箱：回調線程只入隊，由單一長駐協程批量消費
+        self._inbox = deque()
+        self._inbox_ev = asyncio.Event()
+        self._drain_task = None
+        self._stopping = False
+        self.max_write_batch = 256  # 單次喚醒連續處理的回調上限
+        
+        # 錄製列定義：行以tuple存入緩衝區，列名全體共享一份
+        self._record_fields = [
+            "timestamp_ns", "exchange", "market_id", "event_type",
+            "best_bid", "best_ask", "best_bid_size", "best_ask_size",
+            "spread", "spread_percent", "mid_price",
+            "total_bid_volume", "total_ask_volume",
+        ]
+        for i in range(self.depth_levels):
+            self._record_fields += [f"bid_px_{i}", f"bid_sz_{i}", f"ask_px_{i}", f"ask_sz_{i}"]
+        
+        # 預分配的顯示/錄製行：常量字段只填一次，熱路徑就地覆寫
+        self._display_row = {key: None for key in self._record_fields}
+        self._display_row["exchange"] = "lighter"
+        self._display_row["event_type"] = "orderbook_update"
+        # 預生成各檔位鍵名，避免每條消息做f-string拼接
+        self._level_keys = [(f"bid_px_{i}", f"bid_sz_{i}", f"ask_px_{i}", f"ask_sz_{i}")
+                            for i in range(self.depth_levels)]
+        
+        # 刷盤串行化：ColumnBuffer雙緩衝要求同一時刻至多一次flush在途
+        self._flush_lock = asyncio.Lock()
+        # 數據緩衝區：SoA列式緩衝，追加標量而非整行tuple，滿載時丟新記錄
+        self.data_buffer = ColumnBuffer(
+            self._record_fields,
+            typecodes={"timestamp_ns": 'q', "market_id": 'q',
+                       "exchange": None, "event_type": None},
+            capacity=buffer_size * 2)
+        # 刷盤執行器：由統一錄製器注入共享線程池，獨立運行時用默認池
+        self.write_executor = None
         self.last_flush_time = time.time()
-        self.flush_interval = 3  # 秒
-        self.buffer_size = 500
+        self.flush_interval = flush_interval  # 秒
+        self.buffer_size = buffer_size
         
         # 統計信息
         self.msg_count = 0
@@ -40,24 +80,33 @@ class LighterOrderbookRecorder:
         if self.enable_recording:
             self.data_dir = Path("orderbook_data/lighter")
             self.data_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Parquet追加寫入器（每小時一個文件，保持打開狀態追加row group）
+        self._pq_writer = None
+        self._pq_hour = None
+        self._pq_path = None
     
     def process_orderbook_data(self, market_id, order_book):
         """處理訂單簿數據並計算衍生指標"""
-        timestamp = datetime.now()
         
         # 提取賣單和買單
         asks = order_book.get("asks", [])
         bids = order_book.get("bids", [])
         
-        # 排序買賣單
-        sorted_asks = sorted(asks, key=lambda x: float(x["price"]))[:10]
-        sorted_bids = sorted(bids, key=lambda x: float(x["price"]), reverse=True)[:10]
+        # 一次性批量轉換價格/數量字符串，避免逐檔多次float()調用
+        k = self.depth_levels
+        ask_arr = np.array([[a["price"], a["size"]] for a in asks], dtype=np.float64) if asks else np.empty((0, 2))
+        bid_arr = np.array([[b["price"], b["size"]] for b in bids], dtype=np.float64) if bids else np.empty((0, 2))
+        
+        # 排序並截取前N檔
+        ask_arr = ask_arr[np.argsort(ask_arr[:, 0])][:k]
+        bid_arr = bid_arr[np.argsort(-bid_arr[:, 0])][:k]
         
         # 計算最佳買賣價
-        best_bid = float(sorted_bids[0]["price"]) if sorted_bids else None
-        best_ask = float(sorted_asks[0]["price"]) if sorted_asks else None
-        best_bid_size = float(sorted_bids[0]["size"]) if sorted_bids else None
-        best_ask_size = float(sorted_asks[0]["size"]) if sorted_asks else None
+        best_bid = bid_arr[0, 0] if len(bid_arr) else None
+        best_ask = ask_arr[0, 0] if len(ask_arr) else None
+        best_bid_size = bid_arr[0, 1] if len(bid_arr) else None
+        best_ask_size = ask_arr[0, 1] if len(ask_arr) else None
         
         # 計算價差和中間價
         spread = (best_ask - best_bid) if (best_bid and best_ask) else None
@@ -65,76 +114,100 @@ class LighterOrderbookRecorder:
         mid_price = ((best_bid + best_ask) / 2) if (best_bid and best_ask) else None
         
         # 計算總量
-        total_bid_volume = sum([float(bid["size"]) for bid in sorted_bids])
-        total_ask_volume = sum([float(ask["size"]) for ask in sorted_asks])
+        total_bid_volume = bid_arr[:, 1].sum() if len(bid_arr) else 0.0
+        total_ask_volume = ask_arr[:, 1].sum() if len(ask_arr) else 0.0
         
-        return {
-            "timestamp": timestamp.isoformat(),
-            "exchange": "lighter",
-            "market_id": market_id,
-            "event_type": "orderbook_update",
-            "bids": [[float(bid["price"]), float(bid["size"])] for bid in sorted_bids],
-            "asks": [[float(ask["price"]), float(ask["size"])] for ask in sorted_asks],
-            "best_bid": best_bid,
-            "best_ask": best_ask,
-            "best_bid_size": best_bid_size,
-            "best_ask_size": best_ask_size,
-            "spread": spread,
-            "spread_percent": spread_percent,
-            "mid_price": mid_price,
-            "total_bid_volume": total_bid_volume,
-            "total_ask_volume": total_ask_volume
-        }
+        # SoA佈局：前N檔展平成固定的float64標量列，空檔補NaN
+        bid_px = np.full(k, np.nan)
+        bid_sz = np.full(k, np.nan)
+        ask_px = np.full(k, np.nan)
+        ask_sz = np.full(k, np.nan)
+        bid_px[:len(bid_arr)] = bid_arr[:, 0]
+        bid_sz[:len(bid_arr)] = bid_arr[:, 1]
+        ask_px[:len(ask_arr)] = ask_arr[:, 0]
+        ask_sz[:len(ask_arr)] = ask_arr[:, 1]
+        
+        # 就地覆寫預分配的行，不再每條消息新建dict
+        row = self._display_row
+        row["timestamp_ns"] = time.time_ns()
+        row["market_id"] = market_id
+        row["best_bid"] = best_bid
+        row["best_ask"] = best_ask
+        row["best_bid_size"] = best_bid_size
+        row["best_ask_size"] = best_ask_size
+        row["spread"] = spread
+        row["spread_percent"] = spread_percent
+        row["mid_price"] = mid_price
+        row["total_bid_volume"] = total_bid_volume
+        row["total_ask_volume"] = total_ask_volume
+        for i, (kbp, kbs, kap, kas) in enumerate(self._level_keys):
+            row[kbp] = bid_px[i]
+            row[kbs] = bid_sz[i]
+            row[kap] = ask_px[i]
+            row[kas] = ask_sz[i]
+        return row
+    
+    @staticmethod
+    def _format_rows(rows):
+        """固定寬度f-string渲染，省去tabulate的動態寬度計算開銷"""
+        lines = [f"{'價格':>12} {'數量':>12} {'總值':>14}"]
+        lines.extend(f"{p:>12.2f} {q:>12.2f} {v:>14.2f}" for p, q, v in rows)
+        return '\n'.join(lines)
     
     def display_orderbook(self, data):
         """顯示訂單簿數據"""
-        # 清屏（可選）
-        os.system('clear' if os.name == 'posix' else 'cls')
-        
-        print(f"\n{'='*60}")
-        print(f"🌟 Lighter合約實時訂單簿 - Market {data['market_id']}")
-        print(f"📅 時間: {data['timestamp'][:19]}")
-        print(f"{'='*60}")
+        # ANSI清屏序列與整屏內容合併後一次性寫出，避免每次刷新約20次print的stdout鎖開銷
+        lines = ['\x1b[H\x1b[2J']
+        lines.append(f"\n{'='*60}")
+        lines.append(f"🌟 Lighter合約實時訂單簿 - Market {data['market_id']}")
+        lines.append(f"📅 時間: {datetime.fromtimestamp(data['timestamp_ns'] / 1e9).strftime('%Y-%m-%d %H:%M:%S')}")
+        lines.append(f"{'='*60}")
         
         # 顯示最佳價格信息
         if data['best_bid'] and data['best_ask']:
-            print(f"🟢 最佳買價: {data['best_bid']:.2f} (數量: {data['best_bid_size']:.2f})")
-            print(f"🔴 最佳賣價: {data['best_ask']:.2f} (數量: {data['best_ask_size']:.2f})")
-            print(f"📊 中間價: {data['mid_price']:.2f}")
-            print(f"📈 價差: {data['spread']:.2f} ({data['spread_percent']:.3f}%)")
+            lines.append(f"🟢 最佳買價: {data['best_bid']:.2f} (數量: {data['best_bid_size']:.2f})")
+            lines.append(f"🔴 最佳賣價: {data['best_ask']:.2f} (數量: {data['best_ask_size']:.2f})")
+            lines.append(f"📊 中間價: {data['mid_price']:.2f}")
+            lines.append(f"📈 價差: {data['spread']:.2f} ({data['spread_percent']:.3f}%)")
         
-        print(f"💰 總買量: {data['total_bid_volume']:.2f} | 總賣量: {data['total_ask_volume']:.2f}")
-        print()
+        lines.append(f"💰 總買量: {data['total_bid_volume']:.2f} | 總賣量: {data['total_ask_volume']:.2f}")
+        lines.append("")
         
         # 格式化賣單數據（從高到低）
         asks_display = []
-        for price, qty in reversed(data['asks']):
+        for i in reversed(range(self.depth_levels)):
+            price = data[f"ask_px_{i}"]
+            qty = data[f"ask_sz_{i}"]
+            if np.isnan(price):
+                continue
             total_value = price * qty
-            asks_display.append([f"{price:.2f}", f"{qty:.2f}", f"{total_value:.2f}"])
+            asks_display.append((price, qty, total_value))
         
         # 顯示賣單
         if asks_display:
-            print("📈 賣單 (Asks)")
-            print(tabulate(asks_display, 
-                          headers=["價格", "數量", "總值"],
-                          tablefmt="pretty",
-                          stralign="right"))
+            lines.append("📈 賣單 (Asks)")
+            lines.append(self._format_rows(asks_display))
         
-        print(f"\n{' '*20}--- 價差: {data['spread']:.2f} ---\n")
+        lines.append(f"\n{' '*20}--- 價差: {data['spread']:.2f} ---\n")
         
         # 格式化買單數據（從高到低）
         bids_display = []
-        for price, qty in data['bids']:
+        for i in range(self.depth_levels):
+            price = data[f"bid_px_{i}"]
+            qty = data[f"bid_sz_{i}"]
+            if np.isnan(price):
+                continue
             total_value = price * qty
-            bids_display.append([f"{price:.2f}", f"{qty:.2f}", f"{total_value:.2f}"])
+            bids_display.append((price, qty, total_value))
         
         # 顯示買單
         if bids_display:
-            print("📉 買單 (Bids)")
-            print(tabulate(bids_display,
-                          headers=["價格", "數量", "總值"],
-                          tablefmt="pretty",
-                          stralign="right"))
+            lines.append("📉 買單 (Bids)")
+            lines.append(self._format_rows(bids_display))
+        
+        # 整屏單次write+flush
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
     
     def display_stats(self):
         """顯示統計信息"""
@@ -142,11 +215,12 @@ class LighterOrderbookRecorder:
         elapsed = current_time - self.start_time
         rate = self.msg_count / elapsed if elapsed > 0 else 0
         
-        print(f"\n📊 統計信息:")
-        print(f"   消息總數: {self.msg_count}")
-        print(f"   接收頻率: {rate:.2f} msg/sec")
-        print(f"   緩衝區大小: {len(self.data_buffer)}")
-        print(f"   運行時間: {elapsed:.0f}秒")
+        sys.stdout.write(f"\n📊 統計信息:\n"
+                         f"   消息總數: {self.msg_count}\n"
+                         f"   接收頻率: {rate:.2f} msg/sec\n"
+                         f"   緩衝區大小: {len(self.data_buffer)}\n"
+                         f"   運行時間: {elapsed:.0f}秒\n")
+        sys.stdout.flush()
     
     async def check_flush_buffer(self):
         """檢查是否需要刷新緩衝區"""
@@ -160,77 +234,145 @@ class LighterOrderbookRecorder:
         if not self.data_buffer:
             return
         
+        async with self._flush_lock:
+            if not self.data_buffer:
+                return
+            # 原子換出：整組列的零拷貝視圖交給刷盤線程，備用列立即接收
+            snapshot = self.data_buffer.take()
+            self.last_flush_time = time.time()
+            
+            # Arrow表構建和磁盤寫入全部移出事件循環；
+            # 鎖保證下一次take()前本次寫盤已結束，視圖不會被覆寫
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.write_executor, self._do_flush, snapshot)
+    
+    def _do_flush(self, snapshot):
+        """同步刷盤助手：在線程池中構建Arrow表並追加寫入"""
         try:
-            # 獲取當前小時的文件名
+            # 按小時輪轉：跨小時時關閉舊writer並開新文件
             now = datetime.now()
-            # 使用更規範的文件名格式：lighter_orderbook_BTCUSDT_YYYY_MM_DD_HH.parquet
-            filename = f"lighter_orderbook_market{self.market_ids[0]}_{now.strftime('%Y_%m_%d_%H')}.parquet"
-            filepath = self.data_dir / filename
+            hour = now.strftime('%Y_%m_%d_%H')
             
-            # 轉換為DataFrame
-            df = pd.DataFrame(list(self.data_buffer))
+            # snapshot已是列式數組：數值列零拷貝進Arrow，無需轉置
+            table = pa.Table.from_arrays([pa.array(col) for col in snapshot],
+                                         names=self._record_fields)
             
-            # 保存到parquet文件（追加模式）
-            if filepath.exists():
-                existing_df = pd.read_parquet(filepath)
-                df = pd.concat([existing_df, df], ignore_index=True)
+            if self._pq_writer is None or hour != self._pq_hour:
+                self.close_writer()
+                filename = f"lighter_orderbook_market{self.market_ids[0]}_{hour}.parquet"
+                self._pq_path = self.data_dir / filename
+                # 同小時文件已存在（進程重啟、關停後的遲到刷盤）時換新
+                # 文件名：重開ParquetWriter會截斷已寫好的文件
+                seq = 1
+                while self._pq_path.exists():
+                    self._pq_path = self.data_dir / (
+                        f"lighter_orderbook_market{self.market_ids[0]}_{hour}_{seq}.parquet")
+                    seq += 1
+                self._pq_writer = pq.ParquetWriter(
+                    self._pq_path, table.schema, compression='snappy',
+                    use_dictionary=True, data_page_size=1 << 20)
+                self._pq_hour = hour
             
-            df.to_parquet(filepath, engine='pyarrow', compression='snappy')
+            # 只追加新的row group，避免讀回整個小時文件再整體重寫
+            if table.schema != self._pq_writer.schema:
+                table = table.cast(self._pq_writer.schema)
+            self._pq_writer.write_table(table)
             
-            print(f"\n💾 已保存 {len(self.data_buffer)} 條記錄到 {filepath}")
-            logger.info(f"Flushed {len(self.data_buffer)} records to {filepath}")
-            
-            # 清空緩衝區
-            self.data_buffer.clear()
-            self.last_flush_time = time.time()
+            logger.info("Flushed %d records to %s", table.num_rows, self._pq_path)
             
         except Exception as e:
-            logger.error(f"刷新緩衝區時出錯: {e}", exc_info=True)
+            logger.error("刷新緩衝區時出錯: %s", e, exc_info=True)
     
     def on_order_book_update(self, market_id, order_book):
-        """訂單簿更新回調函數 - 同步版本"""
+        """訂單簿更新回調函數 - 在回調線程中只做入隊"""
         try:
-            # 創建異步任務
-            asyncio.run_coroutine_threadsafe(
-                self._process_order_book_update(market_id, order_book),
-                self.loop
-            )
+            # 不為每條回調創建新協程/Task，只喚醒長駐的消費協程
+            self._inbox.append((market_id, order_book))
+            self.loop.call_soon_threadsafe(self._wake_drainer)
         except Exception as e:
-            logger.error(f"創建訂單簿更新任務時出錯: {e}", exc_info=True)
+            logger.error("入隊訂單簿更新時出錯: %s", e, exc_info=True)
+    
+    def _wake_drainer(self):
+        """在事件循環線程內喚醒（必要時創建）消費協程"""
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = self.loop.create_task(self._drain_inbox())
+        self._inbox_ev.set()
+    
+    async def _drain_inbox(self):
+        """長駐消費協程：每次喚醒後批量清空收件箱
+
+        _stopping置位後清空殘餘回調即自行退出；停止流程不用cancel()，
+        取消會在刷盤的run_in_executor等待點打斷協程並釋放_flush_lock，
+        而_do_flush仍在池線程裡寫文件，與最終刷盤並發寫壞同一小時文件。
+        """
+        while True:
+            await self._inbox_ev.wait()
+            self._inbox_ev.clear()
+            drained = 0
+            while self._inbox:
+                market_id, order_book = self._inbox.popleft()
+                await self._process_order_book_update(market_id, order_book)
+                drained += 1
+                if drained >= self.max_write_batch:
+                    # 讓出事件循環，避免單次喚醒長時間獨佔
+                    await asyncio.sleep(0)
+                    drained = 0
+            if self._stopping:
+                break
 
     async def _process_order_book_update(self, market_id, order_book):
         """訂單簿更新的異步處理函數"""
         try:
             # 統計信息
             self.msg_count += 1
-            self.last_update_time = datetime.now()
+            self.last_update_time = time.time()
             
             # 處理數據（顯示和錄製）
             processed_data = self.process_orderbook_data(market_id, order_book)
             
-            # 顯示訂單簿
-            self.display_orderbook(processed_data)
+            # 顯示訂單簿（限流刷新，熱路徑上跳過渲染）
+            if self.enable_display:
+                now = time.time()
+                if now - self.last_display_time >= self.display_interval:
+                    self.display_orderbook(processed_data)
+                    self.last_display_time = now
             
             # 錄製數據
             if self.enable_recording:
-                self.data_buffer.append(processed_data)
+                self.data_buffer.append(tuple(processed_data[k] for k in self._record_fields))
                 await self.check_flush_buffer()
             
             # 定期顯示統計信息
-            if self.msg_count % 50 == 0:
+            if self.enable_display and self.msg_count % 50 == 0:
                 self.display_stats()
                 
         except Exception as e:
-            logger.error(f"處理訂單簿更新時出錯: {e}", exc_info=True)
+            logger.error("處理訂單簿更新時出錯: %s", e, exc_info=True)
     
     def on_account_update(self, account_id, account):
         """賬戶更新回調函數 - 已棄用"""
         pass
     
+    def close_writer(self):
+        """關閉當前的parquet writer（寫入文件尾部元數據）"""
+        if self._pq_writer is not None:
+            try:
+                self._pq_writer.close()
+            except Exception as e:
+                logger.error("關閉parquet writer時出錯: %s", e, exc_info=True)
+            self._pq_writer = None
+
     async def stop(self):
         """停止程序並保存剩餘數據"""
+        if self._drain_task is not None and not self._drain_task.done():
+            # 協作式關停：喚醒消費協程讓它清空收件箱後自行退出，在途刷盤得以完成
+            self._stopping = True
+            self._inbox_ev.set()
+            await self._drain_task
+        self._drain_task = None
         if self.enable_recording and self.data_buffer:
             await self.flush_buffer()
+        self.close_writer()
         print(f"\n🛑 程序已停止")
 
 async def main():
@@ -240,13 +382,15 @@ async def main():
     parser = argparse.ArgumentParser(description='Lighter合約實時Orderbook收集程序')
     parser.add_argument('--markets', nargs='+', type=int, default=[1], help='Market ID列表')
     parser.add_argument('--record', action='store_true', help='啟用數據錄製')
+    parser.add_argument('--display', action='store_true', help='強制啟用訂單簿顯示（錄製模式下默認關閉）')
     
     args = parser.parse_args()
     
     # 創建Lighter orderbook錄製器
     recorder = LighterOrderbookRecorder(
         market_ids=args.markets,
-        enable_recording=args.record
+        enable_recording=args.record,
+        enable_display=True if args.display else None
     )
     
     try:
@@ -267,7 +411,7 @@ async def main():
         print(f"\n\033[1;33m收到停止信號...\033[0m")
         await recorder.stop()
     except Exception as e:
-        logger.error(f"程序運行時出錯: {e}", exc_info=True)
+        logger.error("程序運行時出錯: %s", e, exc_info=True)
         await recorder.stop()
 
 if __name__ == "__main__":
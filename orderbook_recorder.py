@@ -11,6 +11,8 @@ import time
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Optional, Any
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import pandas as pd
 from collections import deque
 import psutil
@@ -23,8 +25,54 @@ from binance_futures_orderbook import BinanceFuturesOrderbook
 from lighter_orderbook import LighterOrderbookRecorder
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# 關閉每條日誌的線程/進程信息採集與調用棧回溯，格式串用不到這些字段
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 logger = logging.getLogger(__name__)
 
+def _binance_builder(cls, prefix):
+    """生成幣安類收集器的構建函數（現貨/合約僅類與前綴不同）"""
+    def build(cfg, storage_config, symbols):
+        collectors = {}
+        for symbol in (symbols or cfg.get('symbols', ['BTCUSDT'])):
+            collectors[f"{prefix}_{symbol}"] = cls(
+                symbol=symbol,
+                depth_levels=cfg.get('depth_levels', 20),
+                enable_recording=True,
+                buffer_size=cfg.get('buffer_size', 1000),
+                flush_interval=cfg.get('flush_interval', 5),
+                record_mode=storage_config.get('mode', 'raw'),
+                snapshot_interval=storage_config.get('snapshot_interval_ms', 10) / 1000
+            )
+        return collectors
+    return build
+
+def _lighter_builder(cfg, storage_config, symbols):
+    """Lighter一個收集器訂閱全部market_ids，不按符號拆分"""
+    return {
+        "lighter_markets": LighterOrderbookRecorder(
+            market_ids=cfg.get('market_ids', [1]),
+            enable_recording=True,
+            buffer_size=cfg.get('buffer_size', 500),
+            flush_interval=cfg.get('flush_interval', 3)
+        )
+    }
+
+# 收集器註冊表：新交易所在此註冊構建函數即可，無需改動創建邏輯
+COLLECTOR_REGISTRY = {
+    'binance_spot': _binance_builder(BinanceSpotOrderbook, 'binance_spot'),
+    'binance_futures': _binance_builder(BinanceFuturesOrderbook, 'binance_futures'),
+    'lighter': _lighter_builder,
+}
+
+@dataclass(slots=True)
+class ExchangeStats:
+    """單個收集器的統計：槽位布局，省去每實例dict"""
+    messages: int = 0
+    last_update: float = 0.0
+    start_time: float = 0.0
+
 class OrderbookRecorder:
     """統一orderbook錄製管理器"""
     
@@ -32,30 +80,55 @@ class OrderbookRecorder:
         self.config = config
         self.collectors = {}
         self.tasks = []
+        self.collector_tasks = {}
         self.start_time = time.time()
         self.is_running = False
+        # 停止事件：信號/定時器只置位，關閉流程統一由主協程執行
+        self._stop_event = asyncio.Event()
+        self._loop = None
         self.stats = {
             'total_messages': 0,
             'total_records_saved': 0,
             'exchanges': {}
         }
         
+        # 緩存進程句柄並預熱cpu_percent：首次調用返回0，之後測量兩次調用間的區間
+        self._proc = psutil.Process()
+        self._proc.cpu_percent(None)
+
+        # 共享寫盤線程池：parquet編碼在此執行，避免阻塞事件循環搶佔WS接收
+        write_threads = config.get('performance', {}).get('write_threads', 2)
+        self.writer_pool = ThreadPoolExecutor(max_workers=write_threads,
+                                              thread_name_prefix='pq-writer')
+
         # 創建主數據目錄
         self.base_data_dir = Path(config.get('base_data_dir', 'orderbook_data'))
         self.base_data_dir.mkdir(parents=True, exist_ok=True)
         
-        # 設置信號處理
-        signal.signal(signal.SIGINT, self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
+    def _signal_handler(self, signum, frame=None):
+        """信號處理器：只置位停止事件，不在信號上下文裡啟動協程"""
+        logger.info("收到信號 %s，開始停止程序...", signum)
+        self._loop.call_soon_threadsafe(self._stop_event.set)
     
-    def _signal_handler(self, signum, frame):
-        """信號處理器"""
-        logger.info(f"收到信號 {signum}，開始停止程序...")
-        asyncio.create_task(self.stop())
+    def _register_signal_handlers(self):
+        """在運行中的事件循環上註冊信號處理
+
+        signal.signal的回調在循環上下文之外執行，create_task可能
+        拋出no running event loop；add_signal_handler保證回調在
+        循環線程內運行。Windows不支持時回退到signal.signal。
+        """
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._signal_handler, sig)
+            except NotImplementedError:
+                signal.signal(sig, self._signal_handler)
     
     async def start_recording(self, symbols: List[str] = None, duration_hours: int = None):
         """開始錄製"""
         self.is_running = True
+        self._register_signal_handlers()
         
         print(f"\033[1;32m🚀 啟動統一Orderbook錄製系統\033[0m")
         print(f"📅 開始時間: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -83,82 +156,61 @@ class OrderbookRecorder:
             self.tasks.append(asyncio.create_task(self._auto_stop(duration_hours)))
         
         try:
-            # 等待所有任務完成
-            await asyncio.gather(*self.tasks, return_exceptions=True)
+            # 監督所有任務：停止事件或任一任務異常都喚醒主協程，
+            # 由它統一取消兄弟任務，避免信號回調與gather互相競爭。
+            # 看門狗可能把被取消的連接任務換成新任務，因此循環刷新監督集合
+            stop_wait = asyncio.create_task(self._stop_event.wait())
+            while True:
+                done, _pending = await asyncio.wait([*self.tasks, stop_wait],
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                if self._stop_event.is_set():
+                    break
+                failed = [t for t in done
+                          if t is not stop_wait and not t.cancelled()
+                          and t.exception() is not None]
+                if failed:
+                    for task in failed:
+                        logger.error("收集任務異常: %s", task.exception())
+                    break
+                self.tasks = [t for t in self.tasks if not t.done()]
+                if not self.tasks:
+                    break
+            stop_wait.cancel()
+            for task in self.tasks:
+                if not task.done():
+                    task.cancel()
+            alive = [t for t in self.tasks if not t.done()]
+            if alive:
+                await asyncio.wait(alive, timeout=5)
         except Exception as e:
-            logger.error(f"錄製過程中出錯: {e}")
+            logger.error("錄製過程中出錯: %s", e)
         finally:
             await self.stop()
     
     async def _create_collectors(self, symbols: List[str] = None):
         """創建各交易所收集器"""
         exchanges_config = self.config.get('exchanges', {})
+        storage_config = self.config.get('storage', {})
         
-        # 幣安現貨
-        if exchanges_config.get('binance_spot', {}).get('enabled', False):
-            spot_config = exchanges_config['binance_spot']
-            spot_symbols = symbols or spot_config.get('symbols', ['BTCUSDT'])
-            
-            for symbol in spot_symbols:
-                collector_id = f"binance_spot_{symbol}"
-                self.collectors[collector_id] = BinanceSpotOrderbook(
-                    symbol=symbol,
-                    depth_levels=spot_config.get('depth_levels', 20),
-                    enable_recording=True
-                )
-                self.stats['exchanges'][collector_id] = {
-                    'messages': 0,
-                    'last_update': None,
-                    'start_time': time.time()
-                }
-        
-        # 幣安合約
-        if exchanges_config.get('binance_futures', {}).get('enabled', False):
-            futures_config = exchanges_config['binance_futures']
-            futures_symbols = symbols or futures_config.get('symbols', ['BTCUSDT'])
-            
-            for symbol in futures_symbols:
-                collector_id = f"binance_futures_{symbol}"
-                self.collectors[collector_id] = BinanceFuturesOrderbook(
-                    symbol=symbol,
-                    depth_levels=futures_config.get('depth_levels', 20),
-                    enable_recording=True
-                )
-                self.stats['exchanges'][collector_id] = {
-                    'messages': 0,
-                    'last_update': None,
-                    'start_time': time.time()
-                }
-        
-        # Lighter合約
-        if exchanges_config.get('lighter', {}).get('enabled', False):
-            lighter_config = exchanges_config['lighter']
-            market_ids = lighter_config.get('market_ids', [1])
-            
-            collector_id = "lighter_markets"
-            self.collectors[collector_id] = LighterOrderbookRecorder(
-                market_ids=market_ids,
-                account_ids=[],
-                enable_recording=True
-            )
-            self.stats['exchanges'][collector_id] = {
-                'messages': 0,
-                'last_update': None,
-                'start_time': time.time()
-            }
+        for exchange, build in COLLECTOR_REGISTRY.items():
+            cfg = exchanges_config.get(exchange, {})
+            if not cfg.get('enabled', False):
+                continue
+            for collector_id, collector in build(cfg, storage_config, symbols).items():
+                collector.write_executor = self.writer_pool
+                self.collectors[collector_id] = collector
+                self.stats['exchanges'][collector_id] = ExchangeStats(start_time=time.time())
         
-        logger.info(f"創建了 {len(self.collectors)} 個收集器")
+        logger.info("創建了 %d 個收集器", len(self.collectors))
     
     async def _start_all_collectors(self):
         """啟動所有收集器"""
         for collector_id, collector in self.collectors.items():
             if 'binance_spot' in collector_id:
                 task = asyncio.create_task(collector.connect())
-                self.tasks.append(task)
                 
             elif 'binance_futures' in collector_id:
                 task = asyncio.create_task(collector.connect())
-                self.tasks.append(task)
                 
             elif 'lighter' in collector_id:
                 # Lighter需要特殊處理
@@ -169,69 +221,109 @@ class OrderbookRecorder:
                     on_order_book_update=collector.on_order_book_update,
                 )
                 task = asyncio.create_task(client.run_async())
-                self.tasks.append(task)
+            
+            self.tasks.append(task)
+            self.collector_tasks[collector_id] = task
         
-        logger.info(f"啟動了 {len(self.tasks)} 個收集任務")
+        logger.info("啟動了 %d 個收集任務", len(self.tasks))
     
     async def _stats_monitor(self):
         """統計監控任務"""
         while self.is_running:
             try:
                 await asyncio.sleep(30)  # 每30秒更新一次統計
+                self._check_stale_collectors()
                 self._display_overall_stats()
             except asyncio.CancelledError:
                 break
             except Exception as e:
-                logger.error(f"統計監控錯誤: {e}")
+                logger.error("統計監控錯誤: %s", e)
+    
+    def _check_stale_collectors(self):
+        """殭屍連接看門狗
+
+        交易所偶爾會在TCP與ping/pong正常的情況下停止推送深度更新，
+        此時底層不會斷開、重連邏輯也不會觸發。這裡按收集器的
+        _last_msg_mono檢查靜默時長，超過閾值就取消舊連接任務並
+        重新調度connect()，避免靜默造成多分鐘的數據缺口。
+        """
+        now = time.monotonic()
+        for collector_id, collector in self.collectors.items():
+            threshold = getattr(collector, 'stale_threshold', None)
+            if threshold is None:
+                continue
+            task = self.collector_tasks.get(collector_id)
+            if task is None or task.done():
+                continue
+            silence = now - collector._last_msg_mono
+            if silence <= threshold:
+                continue
+            logger.warning("%s 已 %.0f 秒無消息，強制重連", collector_id, silence)
+            task.cancel()
+            new_task = asyncio.create_task(collector.connect())
+            self.collector_tasks[collector_id] = new_task
+            try:
+                self.tasks[self.tasks.index(task)] = new_task
+            except ValueError:
+                self.tasks.append(new_task)
+            collector._last_msg_mono = now
     
     async def _auto_stop(self, duration_hours: int):
         """自動停止任務"""
         try:
             await asyncio.sleep(duration_hours * 3600)
-            logger.info(f"達到設定的錄製時長 {duration_hours} 小時，自動停止")
-            await self.stop()
+            logger.info("達到設定的錄製時長 %s 小時，自動停止", duration_hours)
+            self._stop_event.set()
         except asyncio.CancelledError:
             pass
     
     def _display_overall_stats(self):
         """顯示整體統計信息"""
+        # 無人讀取時直接跳過：不做任何算術與字符串格式化
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        
         current_time = time.time()
         elapsed = current_time - self.start_time
         
-        print(f"\n{'='*80}")
-        print(f"📊 統一Orderbook錄製系統統計 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"{'='*80}")
-        print(f"⏱️  運行時間: {elapsed/3600:.1f} 小時 ({elapsed:.0f} 秒)")
+        lines = [
+            f"\n{'='*80}",
+            f"📊 統一Orderbook錄製系統統計 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            f"{'='*80}",
+            f"⏱️  運行時間: {elapsed/3600:.1f} 小時 ({elapsed:.0f} 秒)",
+        ]
         
-        # 系統資源
-        process = psutil.Process()
-        memory_mb = process.memory_info().rss / 1024 / 1024
-        cpu_percent = process.cpu_percent()
+        # 系統資源：複用緩存句柄，CPU%覆蓋整個30秒統計窗口
+        memory_mb = self._proc.memory_info().rss / 1024 / 1024
+        cpu_percent = self._proc.cpu_percent(None)
         
-        print(f"💻 系統資源:")
-        print(f"   內存使用: {memory_mb:.1f} MB")
-        print(f"   CPU使用率: {cpu_percent:.1f}%")
+        lines.append(f"💻 系統資源:")
+        lines.append(f"   內存使用: {memory_mb:.1f} MB")
+        lines.append(f"   CPU使用率: {cpu_percent:.1f}%")
         
         # 各交易所統計
-        print(f"\n📈 各交易所統計:")
+        lines.append(f"\n📈 各交易所統計:")
         total_rate = 0
         
         for collector_id, collector in self.collectors.items():
             if hasattr(collector, 'msg_count'):
                 msg_count = collector.msg_count
-                collector_elapsed = current_time - self.stats['exchanges'][collector_id]['start_time']
+                collector_elapsed = current_time - self.stats['exchanges'][collector_id].start_time
                 rate = msg_count / collector_elapsed if collector_elapsed > 0 else 0
                 total_rate += rate
                 
                 buffer_size = len(collector.data_buffer) if hasattr(collector, 'data_buffer') else 0
                 
-                print(f"   {collector_id}:")
-                print(f"     消息數: {msg_count:,}")
-                print(f"     頻率: {rate:.1f} msg/sec")
-                print(f"     緩衝區: {buffer_size}")
+                lines.append(f"   {collector_id}:")
+                lines.append(f"     消息數: {msg_count:,}")
+                lines.append(f"     頻率: {rate:.1f} msg/sec")
+                lines.append(f"     緩衝區: {buffer_size}")
         
-        print(f"\n🚀 總接收頻率: {total_rate:.1f} msg/sec")
-        print(f"{'='*80}\n")
+        lines.append(f"\n🚀 總接收頻率: {total_rate:.1f} msg/sec")
+        lines.append(f"{'='*80}\n")
+        # 整塊一次寫出，只取一次stdout鎖
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
     
     async def stop(self):
         """停止錄製"""
@@ -247,17 +339,20 @@ class OrderbookRecorder:
                 if hasattr(collector, 'stop'):
                     await collector.stop()
             except Exception as e:
-                logger.error(f"停止收集器 {collector_id} 時出錯: {e}")
+                logger.error("停止收集器 %s 時出錯: %s", collector_id, e)
         
         # 取消所有任務
         for task in self.tasks:
             if not task.done():
                 task.cancel()
         
-        # 等待任務完成
+        # 限時等待任務退出；不用gather以免吞掉取消狀態
         if self.tasks:
-            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await asyncio.wait(self.tasks, timeout=5)
         
+        # 收集器已各自flush，關閉寫盤線程池並等待在途寫入完成
+        self.writer_pool.shutdown(wait=True)
+
         # 顯示最終統計
         self._display_final_stats()
         
@@ -284,14 +379,26 @@ class OrderbookRecorder:
         print(f"💾 數據存儲: {self.base_data_dir}")
         print(f"{'='*80}")
     
-    def flush_all_buffers(self):
-        """強制刷新所有緩衝區"""
+    async def flush_all_buffers(self):
+        """強制刷新所有緩衝區
+
+        逐個await而非create_task：寫盤線程池滿時在這裡可見地承受
+        背壓，而不是靜默堆積未完成任務。
+        """
         for collector_id, collector in self.collectors.items():
             try:
                 if hasattr(collector, 'flush_buffer'):
-                    asyncio.create_task(collector.flush_buffer())
+                    await collector.flush_buffer()
             except Exception as e:
-                logger.error(f"刷新緩衝區 {collector_id} 時出錯: {e}")
+                logger.error("刷新緩衝區 %s 時出錯: %s", collector_id, e)
+
+def deep_merge(base: Dict[str, Any], override: Dict[str, Any]) -> None:
+    """遞歸合併配置：只覆蓋葉子值，保留base中未被提及的嵌套默認項"""
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            deep_merge(base[key], value)
+        else:
+            base[key] = value
 
 def load_config(config_file: str = None) -> Dict[str, Any]:
     """加載配置文件"""
@@ -324,7 +431,9 @@ def load_config(config_file: str = None) -> Dict[str, Any]:
             "format": "parquet",
             "compression": "snappy",
             "file_rotation": "hourly",
-            "max_records_per_file": 100000
+            "max_records_per_file": 100000,
+            "mode": "raw",  # raw=逐條事件；coalesce=按間隔快照（寫入量大幅降低）
+            "snapshot_interval_ms": 10
         },
         "performance": {
             "async_write": True,
@@ -336,12 +445,14 @@ def load_config(config_file: str = None) -> Dict[str, Any]:
     
     if config_file and Path(config_file).exists():
         try:
+            # 配置文件仍用標準庫json：非熱路徑，錯誤信息更友好
             with open(config_file, 'r', encoding='utf-8') as f:
                 user_config = json.load(f)
-            # 合併配置
-            default_config.update(user_config)
+            # 遞歸合併：dict.update會整棵替換exchanges等子樹，用戶只想
+            # 改symbols時會連帶丟掉默認的buffer_size/depth_levels
+            deep_merge(default_config, user_config)
         except Exception as e:
-            logger.warning(f"讀取配置文件失敗: {e}，使用默認配置")
+            logger.warning("讀取配置文件失敗: %s，使用默認配置", e)
     
     return default_config
 
@@ -384,14 +495,20 @@ async def main():
     except KeyboardInterrupt:
         print(f"\n\033[1;33m收到停止信號...\033[0m")
     except Exception as e:
-        logger.error(f"程序運行時出錯: {e}", exc_info=True)
+        logger.error("程序運行時出錯: %s", e, exc_info=True)
     finally:
         await recorder.stop()
 
 if __name__ == "__main__":
+    try:
+        # uvloop可大幅降低事件循環開銷（Windows不支持）
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         print(f"\n\033[1;33m程序被中斷\033[0m")
     except Exception as e:
-        logger.error(f"程序錯誤: {e}", exc_info=True) 
\ No newline at end of file
+        logger.error("程序錯誤: %s", e, exc_info=True) 
\ No newline at end of file
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+列式記錄緩衝區（struct-of-arrays）
+行式tuple緩衝在刷盤時需要轉置，且每行N個標量都裝箱成PyObject；
+這裡為每個字段預分配一條定容numpy列，熱路徑按寫指針存入標量，
+刷盤時直接把零拷貝切片交給pyarrow，既無轉置也無逐次擴容。
+"""
+
+import numpy as np
+
+# 類型碼對應的numpy dtype（None=字符串常量列，用object dtype）
+_NP_DTYPES = {'d': np.float64, 'q': np.int64, None: object}
+
+
+class ColumnBuffer:
+    """固定字段集、定容雙緩衝的列式緩衝區
+
+    fields為列名列表；typecodes將列名映射到類型碼
+    （'d'=float64、'q'=int64、None=字符串），未列出的字段默認'd'。
+    記錄中的None（如單邊空簿時的best_*、鎖定盤口的spread_percent）
+    按列類型落成NaN/0，與原DataFrame路徑存空值的行為對齊。
+    寫滿capacity後丟棄新記錄並計入dropped，與收集器隊列側的
+    丟棄策略一致：寧可丟數據也不無界增長。
+
+    take()換出的是底層數組的零拷貝視圖，內部在兩組預分配列之間
+    輪換：調用方必須在下下次take()前用完視圖——收集器的flush
+    經_flush_lock串行化，天然滿足該約束。
+    """
+
+    def __init__(self, fields, typecodes=None, capacity=2048):
+        self.fields = list(fields)
+        self._dtypes = [_NP_DTYPES[(typecodes or {}).get(name, 'd')]
+                        for name in self.fields]
+        # None的列類型替代值：float列記NaN、int列記0、字符串列原樣
+        self._none_fill = [np.nan if dt is np.float64 else 0 if dt is np.int64 else None
+                           for dt in self._dtypes]
+        self.capacity = capacity
+        self.dropped = 0
+        self._sets = [self._new_columns(), self._new_columns()]
+        self._active = 0
+        self._columns = self._sets[0]
+        self._w = 0
+
+    def _new_columns(self):
+        return [np.empty(self.capacity, dtype=dt) for dt in self._dtypes]
+
+    def __len__(self):
+        return self._w
+
+    def append(self, record):
+        """追加一行（與fields對齊的標量序列），滿載時丟棄"""
+        w = self._w
+        if w >= self.capacity:
+            self.dropped += 1
+            return
+        for col, value, fill in zip(self._columns, record, self._none_fill):
+            col[w] = fill if value is None else value
+        self._w = w + 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def take(self):
+        """換出當前已寫入的列切片並切到備用緩衝
+
+        返回零拷貝視圖列表，由調用方（刷盤線程）獨佔使用；
+        備用列立即開始接收新記錄，無需任何分配。
+        """
+        w, columns = self._w, self._columns
+        self._active ^= 1
+        self._columns = self._sets[self._active]
+        self._w = 0
+        return [col[:w] for col in columns]
@@ -145,7 +145,7 @@ def test_dependencies():
     
     required_packages = [
         'asyncio', 'websockets', 'pandas', 'pyarrow', 
-        'tabulate', 'psutil', 'aiohttp', 'json', 'logging'
+        'psutil', 'aiohttp', 'json', 'logging'
     ]
     
     missing_packages = []
@@ -160,8 +160,6 @@ def test_dependencies():
                 import pandas
             elif package == 'pyarrow':
                 import pyarrow
-            elif package == 'tabulate':
-                import tabulate
             elif package == 'psutil':
                 import psutil
             elif package == 'aiohttp':
@@ -329,6 +327,12 @@ async def main():
         print("\n⚠️  部分測試失敗，請檢查上述錯誤信息")
 
 if __name__ == "__main__":
+    try:
+        # uvloop可大幅降低事件循環開銷（Windows不支持）
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
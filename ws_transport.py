@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+WebSocket傳輸適配層
+picows（Cython實現、與uvloop配合良好）可用時優先使用，
+繞過websockets的幀組裝與每幀協程調度開銷；否則回退到websockets。
+收集器統一通過ws_messages()異步迭代原始payload，重連邏輯仍由各收集器負責。
+"""
+
+import asyncio
+import logging
+
+import websockets
+
+try:
+    import picows
+except ImportError:
+    picows = None
+
+logger = logging.getLogger(__name__)
+
+
+def picows_available():
+    """picows傳輸是否可用"""
+    return picows is not None
+
+
+if picows is not None:
+    class _QueueListener(picows.WSListener):
+        """picows幀回調：payload直接入隊給消費協程，不經過幀組裝層"""
+
+        def __init__(self, queue):
+            self._queue = queue
+
+        def on_ws_frame(self, transport, frame):
+            if frame.msg_type in (picows.WSMsgType.TEXT, picows.WSMsgType.BINARY):
+                # frame底層緩衝會被picows復用，取bytes拷貝後入隊
+                self._queue.put_nowait(frame.get_payload_as_bytes())
+            elif frame.msg_type == picows.WSMsgType.CLOSE:
+                self._queue.put_nowait(None)
+
+        def on_ws_disconnected(self, transport):
+            self._queue.put_nowait(None)
+
+
+async def ws_messages(url, **ws_kwargs):
+    """統一的消息異步生成器：優先picows，回退websockets
+
+    產出原始payload，由調用方解析；連接斷開時生成器正常結束。
+    ws_kwargs僅在websockets回退路徑下生效。
+
+    payload盡可能保持bytes（orjson/msgspec直接接受），調用方
+    不得對其調用.decode()——那會白付一次UTF-8解碼。
+    """
+    if picows is not None:
+        queue = asyncio.Queue()
+        transport, _ = await picows.ws_connect(lambda: _QueueListener(queue), url)
+        try:
+            while True:
+                payload = await queue.get()
+                if payload is None:
+                    break
+                yield payload
+        finally:
+            transport.disconnect()
+        return
+
+    async with websockets.connect(url, **ws_kwargs) as websocket:
+        try:
+            # websockets 14+支持recv(decode=False)：文本幀不做UTF-8解碼，
+            # 原始bytes直達orjson/msgspec
+            while True:
+                yield await websocket.recv(decode=False)
+        except TypeError:
+            # 舊版websockets無decode參數，回退到常規迭代（文本幀為str）
+            async for message in websocket:
+                yield message
+        except websockets.exceptions.ConnectionClosedOK:
+            return